@@ -1,12 +1,30 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import asyncio
 import os
 import time
-from PIL import Image
-from io import BytesIO
+import base64
 import hashlib
+import re
+from collections import deque
 import logging
 
+# orjson decodes the ~1.5 MB b64_json responses several times faster than
+# stdlib json; fall back transparently when it is not installed
+try:
+    import orjson
+
+    def _loads(data):
+        return orjson.loads(data)
+except ImportError:
+    import json
+
+    def _loads(data):
+        return json.loads(data)
+
 # Configure logging (don't log sensitive data)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -20,8 +38,7 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown("""
-<style>
+_CSS = """
     .main { padding-top: 2rem; }
     
     .stTextArea > div > div > textarea {
@@ -61,8 +78,29 @@ st.markdown("""
         border-radius: 5px;
         margin: 10px 0;
     }
-</style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource(show_spinner=False)
+def _inject_css():
+    """Ship the style block once per session instead of on every rerun"""
+    st.markdown(f"<style>{_CSS}</style>", unsafe_allow_html=True)
+    return True
+
+@st.cache_data(show_spinner=False)
+def _header_html():
+    """Build the gradient-title header markup once"""
+    return """
+    <div style='text-align: center; padding: 2rem 0;'>
+        <h1 style='background: linear-gradient(135deg, #667eea, #764ba2);
+                   -webkit-background-clip: text; -webkit-text-fill-color: transparent;
+                   font-size: 3rem; margin-bottom: 0.5rem;'>
+            🔒 Secure AI Image Generator
+        </h1>
+        <p style='font-size: 1.2rem; color: #666; margin-bottom: 2rem;'>
+            Generate images safely with enterprise-grade security
+        </p>
+    </div>
+    """
 
 # Initialize secure session state
 if 'generated_images' not in st.session_state:
@@ -71,14 +109,51 @@ if 'generation_count' not in st.session_state:
     st.session_state.generation_count = 0
 if 'daily_limit_reached' not in st.session_state:
     st.session_state.daily_limit_reached = False
+if 'generation_history' not in st.session_state:
+    # Bounded deque: O(1) prepend and capped memory; entries hold only the
+    # prompt (the generate_cached key), never duplicated image payloads
+    st.session_state.generation_history = deque(maxlen=50)
+
+# Shared HTTP session with connection pooling and retries, so repeated
+# calls to api.openai.com reuse the already-negotiated TLS connection
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+)
+SESSION.mount("https://", _adapter)
 
 # Security configurations
 MAX_DAILY_GENERATIONS = 20  # Prevent abuse
 MAX_PROMPT_LENGTH = 500
 BLOCKED_WORDS = ['nsfw', 'explicit', 'nude', 'violence', 'gore', 'sexual']
 
+# Single compiled scan over the prompt instead of one pass per word;
+# word boundaries avoid false positives on harmless substrings
+_BLOCKED_RE = re.compile(r"\b(?:" + "|".join(map(re.escape, BLOCKED_WORDS)) + r")\b", re.IGNORECASE)
+
+# C-level deletion table for potentially dangerous characters
+_DANGEROUS_CHARS = str.maketrans('', '', '<>{}`')
+
+EXAMPLE_PROMPTS = [
+    "A peaceful mountain landscape with a crystal clear lake at sunset",
+    "A cozy library with floating books and warm golden lighting",
+    "A futuristic city with glass towers and flying cars",
+    "A magical forest with glowing mushrooms and fairy lights",
+    "An astronaut planting flowers on Mars with Earth in the background"
+]
+
+# Stable widget keys: built-in hash() is randomized per process, so keys
+# would change across restarts; blake2b digests are computed once here
+_EXAMPLE_KEYS = [hashlib.blake2b(e.encode(), digest_size=8).hexdigest() for e in EXAMPLE_PROMPTS]
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def test_api_key(api_key):
-    """Test if the API key works with a simple request"""
+    """
+    Test if the API key works with a simple request
+    Cached per key so reruns don't repeat the network round trip
+    """
     try:
         headers = {
             'Authorization': f'Bearer {api_key}',
@@ -86,7 +161,7 @@ def test_api_key(api_key):
         }
         
         # Simple test request to check if API key works
-        response = requests.get(
+        response = SESSION.get(
             'https://api.openai.com/v1/models',
             headers=headers,
             timeout=10
@@ -104,11 +179,9 @@ def test_api_key(api_key):
     except Exception as e:
         return False, f"API test error: {str(e)}"
 
-def get_api_key_safely():
-    """
-    Securely retrieve API key from environment/secrets
-    Returns None if not found or invalid
-    """
+@st.cache_resource(show_spinner=False)
+def _load_api_key():
+    """Resolve and validate the API key once per process"""
     try:
         # Try multiple sources (in order of preference)
         api_key = (
@@ -135,6 +208,18 @@ def get_api_key_safely():
         logger.error(f"Error retrieving API key: {str(e)}")
         return None, "Failed to retrieve API key"
 
+def get_api_key_safely():
+    """
+    Securely retrieve API key from environment/secrets
+    Returns None if not found or invalid
+    """
+    api_key, error = _load_api_key()
+    if api_key is None:
+        # Don't cache failures: adding the key to secrets triggers a rerun
+        # without a process restart, which should pick the new key up
+        _load_api_key.clear()
+    return api_key, error
+
 def validate_prompt_security(prompt):
     """
     Validate prompt for security and content policy
@@ -153,16 +238,12 @@ def validate_prompt_security(prompt):
         return False, "", f"Prompt too long - maximum {MAX_PROMPT_LENGTH} characters"
     
     # Content filtering
-    prompt_lower = cleaned_prompt.lower()
-    for blocked_word in BLOCKED_WORDS:
-        if blocked_word in prompt_lower:
-            return False, "", "Prompt contains inappropriate content"
-    
-    # Additional security checks
-    if any(char in cleaned_prompt for char in ['<', '>', '{', '}', '`']):
-        # Remove potentially dangerous characters
-        cleaned_prompt = ''.join(char for char in cleaned_prompt if char not in '<>{}`')
-    
+    if _BLOCKED_RE.search(cleaned_prompt):
+        return False, "", "Prompt contains inappropriate content"
+
+    # Remove potentially dangerous characters
+    cleaned_prompt = cleaned_prompt.translate(_DANGEROUS_CHARS)
+
     return True, cleaned_prompt, None
 
 def check_rate_limits():
@@ -173,6 +254,36 @@ def check_rate_limits():
     
     return True, None
 
+async def _request_one_image(client, headers, request_data):
+    """Fire a single image-generation request on the shared async client"""
+    return await client.post(
+        'https://api.openai.com/v1/images/generations',
+        headers=headers,
+        json=request_data,
+        timeout=60
+    )
+
+async def _request_images_concurrently(headers, request_data, n_images=2, on_response=None):
+    """
+    Run the image-generation requests concurrently over one pooled client.
+    HTTP/2 multiplexes all requests onto a single TLS connection. Responses
+    are handed to on_response in completion order, so the first finished
+    image can be shown while the other request is still in flight.
+    """
+    limits = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+    async with httpx.AsyncClient(http2=True, timeout=60, limits=limits) as client:
+        tasks = [
+            asyncio.ensure_future(_request_one_image(client, headers, request_data))
+            for _ in range(n_images)
+        ]
+        responses = []
+        for finished in asyncio.as_completed(tasks):
+            response = await finished
+            responses.append(response)
+            if on_response is not None:
+                on_response(response)
+        return responses
+
 def make_secure_api_request(prompt):
     """
     Make secure API request to OpenAI with detailed debugging
@@ -198,84 +309,88 @@ def make_secure_api_request(prompt):
             "n": 1,  # DALL-E 3 only supports n=1
             "size": "1024x1024",
             "quality": "standard",
-            "response_format": "url"
+            "response_format": "b64_json"  # inline bytes: no second download round-trip
         }
         
         # ✅ Safe logging (no sensitive data)
         logger.info(f"Making API request for prompt length: {len(prompt)}")
         
-        # Make TWO separate requests for 2 images (DALL-E 3 limitation)
-        image_urls = []
-        
-        for i in range(2):
-            st.write(f"🎨 Generating image {i+1}/2...")
-            
-            # Make request with timeout
-            response = requests.post(
-                'https://api.openai.com/v1/images/generations',
-                headers=headers,
-                json=request_data,
-                timeout=60
-            )
-            
+        # Make TWO separate requests for 2 images (DALL-E 3 limitation),
+        # fired concurrently since they are independent I/O-bound calls
+        st.write("🎨 Generating 2 images in parallel...")
+        preview_slots = [col.empty() for col in st.columns(2)]
+
+        images = []
+        errors = []
+
+        def _consume_response(response):
+            """Handle one completed response: preview success, record errors"""
             # Debug information (safe to show)
             st.write(f"API Response Status: {response.status_code}")
-            
+
             if response.status_code == 200:
-                result = response.json()
+                result = _loads(response.content)
                 if 'data' in result and len(result['data']) > 0:
-                    image_urls.append(result['data'][0]['url'])
-                    st.write(f"✅ Image {i+1} generated successfully!")
+                    png_bytes = base64.b64decode(result['data'][0]['b64_json'])
+                    images.append(png_bytes)
+                    # Show the image immediately, before the batch finishes
+                    preview_slots[len(images) - 1].image(png_bytes, use_container_width=True)
+                    st.write(f"✅ Image {len(images)} generated successfully!")
                 else:
-                    return False, f"No image data returned for image {i+1}"
-            
+                    errors.append("No image data returned")
+
             elif response.status_code == 429:
-                return False, "Rate limit exceeded. Please wait before trying again."
-            
+                errors.append("Rate limit exceeded. Please wait before trying again.")
+
             elif response.status_code == 400:
                 try:
-                    error_data = response.json()
+                    error_data = _loads(response.content)
                     error_message = error_data.get('error', {}).get('message', 'Unknown error')
-                    
+
                     # Show detailed error for debugging
                     st.write(f"API Error Details: {error_message}")
-                    
+
                     if 'content_policy_violation' in error_message.lower():
-                        return False, "Content policy violation. Please modify your prompt."
+                        errors.append("Content policy violation. Please modify your prompt.")
                     elif 'billing' in error_message.lower():
-                        return False, "Billing issue. Please check your OpenAI account billing."
+                        errors.append("Billing issue. Please check your OpenAI account billing.")
                     elif 'quota' in error_message.lower():
-                        return False, "Usage quota exceeded. Please check your OpenAI usage limits."
+                        errors.append("Usage quota exceeded. Please check your OpenAI usage limits.")
                     else:
-                        return False, f"API Error: {error_message}"
+                        errors.append(f"API Error: {error_message}")
                 except:
-                    return False, f"Bad request (400). Response: {response.text[:200]}"
-            
+                    errors.append(f"Bad request (400). Response: {response.text[:200]}")
+
             elif response.status_code == 401:
-                return False, "Authentication failed. Please check your API key."
-            
+                errors.append("Authentication failed. Please check your API key.")
+
             elif response.status_code == 403:
-                return False, "Access denied. Please check your API key permissions."
-            
+                errors.append("Access denied. Please check your API key permissions.")
+
             else:
                 try:
-                    error_data = response.json()
+                    error_data = _loads(response.content)
                     error_message = error_data.get('error', {}).get('message', 'Unknown error')
-                    return False, f"API Error ({response.status_code}): {error_message}"
+                    errors.append(f"API Error ({response.status_code}): {error_message}")
                 except:
-                    return False, f"API request failed with status {response.status_code}: {response.text[:200]}"
-        
-        if len(image_urls) > 0:
-            logger.info(f"Successfully generated {len(image_urls)} images")
-            return True, image_urls
+                    errors.append(f"API request failed with status {response.status_code}: {response.text[:200]}")
+
+        asyncio.run(_request_images_concurrently(headers, request_data, on_response=_consume_response))
+
+        if errors:
+            return False, errors[0]
+
+        if len(images) > 0:
+            logger.info(f"Successfully generated {len(images)} images")
+            return True, images
         else:
             return False, "No images were generated successfully"
             
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error("Request timeout")
         return False, "Request timed out. Please try again."
-    
-    except requests.exceptions.ConnectionError:
+
+    except httpx.ConnectError:
         logger.error("Connection error")
         return False, "Network connection error. Please check your internet."
     
@@ -284,6 +399,87 @@ def make_secure_api_request(prompt):
         logger.error(f"Unexpected error in API request: {str(e)}")
         return False, f"Unexpected error: {str(e)}"
 
+@st.cache_data(max_entries=32, ttl=24 * 3600, show_spinner=False)
+def generate_cached(prompt):
+    """
+    Generate images for a prompt, serving repeat prompts from cache
+    so identical regenerations skip the API round-trip (and its cost)
+    """
+    # This body only runs on a cache miss, i.e. when the API is really
+    # called - flag it so the caller can count actual spend
+    st.session_state._api_call_made = True
+    success, result = make_secure_api_request(prompt)
+    if not success:
+        # Raise so failures are never cached as results
+        raise RuntimeError(result)
+    return result
+
+@st.fragment
+def display_generation_history():
+    """
+    Show the most recent prompts. Fragments may not write to st.sidebar
+    directly, so the caller wraps this in a `with st.sidebar:` block.
+    """
+    st.markdown("### 🕘 Recent Prompts")
+    if not st.session_state.generation_history:
+        st.caption("No generations yet this session.")
+        return
+    for entry in list(st.session_state.generation_history)[:5]:
+        st.caption(time.strftime("%H:%M", time.localtime(entry['ts'])))
+        st.write(entry['prompt'][:80] + ("…" if len(entry['prompt']) > 80 else ""))
+
+@st.fragment
+def display_usage_metrics():
+    """Render the usage metrics row; other fragments' reruns skip it"""
+    count = st.session_state.generation_count
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Today's Generations", count)
+    col2.metric("Remaining Today", max(0, MAX_DAILY_GENERATIONS - count))
+    col3.metric("Estimated Cost", f"${count * 0.08:.2f}")
+
+def _apply_example_prompt(example):
+    """Callback: runs before widgets instantiate, so the key is writable"""
+    st.session_state.prompt_input = example
+
+@st.fragment
+def display_example_prompts():
+    """Render the example-prompt buttons; interactions rerun only this block"""
+    with st.expander("💡 Safe example prompts"):
+        for example, example_key in zip(EXAMPLE_PROMPTS, _EXAMPLE_KEYS):
+            if st.button(example, key=f"ex_{example_key}",
+                         on_click=_apply_example_prompt, args=(example,)):
+                # The callback already set the state; rerun the whole app so
+                # the text area (outside this fragment) picks it up
+                st.rerun(scope="app")
+
+@st.fragment
+def display_generated_images():
+    """Render the image grid; Download clicks rerun only this fragment"""
+    st.markdown("---")
+    st.markdown("### 🖼️ Generated Images")
+
+    cols = st.columns(2)
+    for i, png_bytes in enumerate(st.session_state.generated_images):
+        with cols[i % 2]:
+            st.markdown(f"#### ✨ Image {i + 1}")
+
+            try:
+                st.image(png_bytes, use_container_width=True)
+
+                # Bytes are already in memory, so the browser gets them
+                # directly - no intermediate click or server-side fetch
+                st.download_button(
+                    label=f"💾 Download Image {i + 1}",
+                    data=png_bytes,
+                    file_name=f"ai_image_{int(time.time())}_{i+1}.png",
+                    mime="image/png",
+                    key=f"save_{i}"
+                )
+
+            except Exception as e:
+                st.error(f"Error loading image {i + 1}")
+                logger.error(f"Image display error: {str(e)}")
+
 def display_security_info():
     """Display security and privacy information"""
     with st.expander("🔒 Security & Privacy Information"):
@@ -303,19 +499,9 @@ def display_security_info():
         """.format(MAX_DAILY_GENERATIONS=MAX_DAILY_GENERATIONS, MAX_PROMPT_LENGTH=MAX_PROMPT_LENGTH))
 
 def main():
-    st.markdown("""
-    <div style='text-align: center; padding: 2rem 0;'>
-        <h1 style='background: linear-gradient(135deg, #667eea, #764ba2); 
-                   -webkit-background-clip: text; -webkit-text-fill-color: transparent; 
-                   font-size: 3rem; margin-bottom: 0.5rem;'>
-            🔒 Secure AI Image Generator
-        </h1>
-        <p style='font-size: 1.2rem; color: #666; margin-bottom: 2rem;'>
-            Generate images safely with enterprise-grade security
-        </p>
-    </div>
-    """, unsafe_allow_html=True)
-    
+    _inject_css()
+    st.markdown(_header_html(), unsafe_allow_html=True)
+
     # Check API key configuration
     api_key, error = get_api_key_safely()
     if not api_key:
@@ -340,7 +526,7 @@ def main():
         
         display_security_info()
         st.stop()
-    
+
     # Test API key
     with st.spinner("🔑 Testing API key..."):
         key_valid, key_message = test_api_key(api_key)
@@ -348,6 +534,9 @@ def main():
     if key_valid:
         st.success(f"✅ {key_message}")
     else:
+        # Don't cache failures: a transient 429 or network blip should be
+        # retried on the next rerun rather than pinned for the full TTL
+        test_api_key.clear()
         st.error(f"❌ API Key Issue: {key_message}")
         st.info("""
         **Common API key issues:**
@@ -359,16 +548,8 @@ def main():
         st.stop()
     
     # Display current usage
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("Today's Generations", st.session_state.generation_count)
-    with col2:
-        remaining = MAX_DAILY_GENERATIONS - st.session_state.generation_count
-        st.metric("Remaining Today", max(0, remaining))
-    with col3:
-        estimated_cost = st.session_state.generation_count * 0.08
-        st.metric("Estimated Cost", f"${estimated_cost:.2f}")
-    
+    display_usage_metrics()
+
     # Check rate limits
     rate_ok, rate_error = check_rate_limits()
     if not rate_ok:
@@ -381,6 +562,7 @@ def main():
     st.markdown("### 🎨 Describe Your Image")
     prompt = st.text_area(
         "Enter your prompt:",
+        key="prompt_input",
         height=100,
         max_chars=MAX_PROMPT_LENGTH,
         placeholder=f"Describe your image in detail... (max {MAX_PROMPT_LENGTH} characters)",
@@ -394,26 +576,8 @@ def main():
         st.markdown(f"<small style='color: {color};'>{char_count}/{MAX_PROMPT_LENGTH} characters</small>", unsafe_allow_html=True)
     
     # Example prompts
-    with st.expander("💡 Safe example prompts"):
-        examples = [
-            "A peaceful mountain landscape with a crystal clear lake at sunset",
-            "A cozy library with floating books and warm golden lighting",
-            "A futuristic city with glass towers and flying cars",
-            "A magical forest with glowing mushrooms and fairy lights",
-            "An astronaut planting flowers on Mars with Earth in the background"
-        ]
-        
-        for example in examples:
-            if st.button(example, key=f"ex_{hash(example)}"):
-                st.session_state.selected_prompt = example
-                st.rerun()
-    
-    # Use selected example
-    if 'selected_prompt' in st.session_state:
-        prompt = st.session_state.selected_prompt
-        del st.session_state.selected_prompt
-        st.rerun()
-    
+    display_example_prompts()
+
     # Generate button
     if st.button("🎨 Generate Images", type="primary", disabled=st.session_state.daily_limit_reached):
         if not prompt:
@@ -430,60 +594,35 @@ def main():
         if st.session_state.generation_count > 10:
             st.warning(f"⚠️ You've made {st.session_state.generation_count} generations today. Each generation costs ~$0.08")
         
-        # Generate images
-        with st.spinner("🎨 Creating your images... This may take 10-30 seconds"):
-            progress = st.progress(0)
-            for i in range(100):
-                time.sleep(0.05)
-                progress.progress(i + 1)
-            
-            success, result = make_secure_api_request(clean_prompt)
-            progress.empty()
-        
-        if success:
+        # Generate images (identical prompts are served from cache). The
+        # call holds this script run for its duration; streamed previews
+        # and status lines render inline while it progresses.
+        try:
+            with st.spinner("🎨 Creating your images... This may take 10-30 seconds"):
+                st.session_state._api_call_made = False
+                result = generate_cached(clean_prompt)
+        except RuntimeError as e:
+            st.error(f"❌ {e}")
+        else:
             st.session_state.generated_images = result
-            st.session_state.generation_count += 1
+            # Cache hits cost nothing - count only real API calls against
+            # the daily limit and the cost estimate
+            if st.session_state._api_call_made:
+                st.session_state.generation_count += 1
+            st.session_state.generation_history.appendleft({
+                'prompt': clean_prompt,
+                'ts': time.time()
+            })
             st.success("🎉 Images generated successfully!")
             st.rerun()
-        else:
-            st.error(f"❌ {result}")
     
     # Display generated images
     if st.session_state.generated_images:
-        st.markdown("---")
-        st.markdown("### 🖼️ Generated Images")
-        
-        cols = st.columns(2)
-        for i, image_url in enumerate(st.session_state.generated_images):
-            with cols[i % 2]:
-                st.markdown(f"#### ✨ Image {i + 1}")
-                
-                try:
-                    st.image(image_url, use_column_width=True)
-                    
-                    # Secure download (don't expose URLs in logs)
-                    if st.button(f"💾 Download Image {i + 1}", key=f"dl_{i}"):
-                        try:
-                            response = requests.get(image_url, timeout=30)
-                            if response.status_code == 200:
-                                st.download_button(
-                                    label=f"⬇️ Save Image {i + 1}",
-                                    data=response.content,
-                                    file_name=f"ai_image_{int(time.time())}_{i+1}.png",
-                                    mime="image/png",
-                                    key=f"save_{i}"
-                                )
-                            else:
-                                st.error("Failed to download image")
-                        except Exception as e:
-                            st.error("Download failed - please try again")
-                            logger.error(f"Download error: {str(e)}")
-                    
-                except Exception as e:
-                    st.error(f"Error loading image {i + 1}")
-                    logger.error(f"Image display error: {str(e)}")
-    
-    # Security information
+        display_generated_images()
+
+    # Recent prompts and security information
+    with st.sidebar:
+        display_generation_history()
     display_security_info()
     
     # Usage warning